@@ -6,20 +6,40 @@ Subcommands:
   start  - login and start a ladder battle
   poll   - join a battle and return the latest request/options
   choose - submit a choice for a battle
+  serve  - keep one logged-in connection and run JSON commands from stdin
 """
 
 import argparse
 import asyncio
-import json
+import os
+import stat
 import sys
+import tempfile
 import time
-from dataclasses import dataclass
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any
 
-import requests
+import httpx
+import orjson
 import websockets
 
+try:
+    import msgpack
+except ImportError:  # only needed for .msgpack state files
+    msgpack = None
+
+
+# After the next request, keep reading battle frames until none arrives for
+# DRAIN_IDLE_S, for at most DRAIN_MAX_S in total.
+DRAIN_IDLE_S = 0.01
+DRAIN_MAX_S = 0.5
+
+
+# httpx defaults to 5 s; the login endpoint can be slower than that.
+LOGIN_TIMEOUT_S = 60.0
+
 
 class LoginError(Exception):
     pass
@@ -35,6 +55,30 @@ class BattleInit:
     title: str | None
 
 
+@dataclass
+class BattleUpdate:
+    last_request: dict[str, Any] | None = None
+    last_turn: int | None = None
+    last_error: str | None = None
+    events: list[str] = field(default_factory=list)
+    finished: bool = False
+    winner: str | None = None
+    tie: bool = False
+
+    def as_tuple(
+        self,
+    ) -> tuple[dict[str, Any] | None, int | None, str | None, list[str], bool, str | None, bool]:
+        return (
+            self.last_request,
+            self.last_turn,
+            self.last_error,
+            self.events,
+            self.finished,
+            self.winner,
+            self.tie,
+        )
+
+
 class PSWebsocketClient:
     websocket = None
     address = None
@@ -42,6 +86,10 @@ class PSWebsocketClient:
     username = None
     password = None
     last_message = None
+    http_client = None
+    rooms = None
+    latest_requests = None
+    latest_turns = None
 
     @classmethod
     async def create(cls, username: str, password: str | None, address: str):
@@ -49,31 +97,70 @@ class PSWebsocketClient:
         self.username = username
         self.password = password
         self.address = address
-        self.websocket = await websockets.connect(self.address)
+        self.rooms = set()
+        self.latest_requests = {}
+        self.latest_turns = {}
+        self.websocket = await websockets.connect(
+            self.address, compression=None, max_size=2**22
+        )
         self.login_uri = (
             "https://play.pokemonshowdown.com/api/login"
             if password
             else "https://play.pokemonshowdown.com/action.php?"
         )
+        self.http_client = httpx.AsyncClient(timeout=LOGIN_TIMEOUT_S)
         return self
 
     async def receive_message(self) -> str:
-        return await self.websocket.recv()
+        message = await self.websocket.recv()
+        if "|request|" in message or "|turn|" in message:
+            self.remember_battle_state(message)
+        return message
+
+    def remember_battle_state(self, message: str) -> None:
+        # Every frame passes through here, including ones callers skip or
+        # discard, so each room's latest raw request and turn stay current.
+        for room, line in iter_messages(message):
+            tag, payload = parse_tag(line)
+            if tag == "request":
+                self.latest_requests[room] = payload
+            elif tag == "turn":
+                try:
+                    self.latest_turns[room] = int(payload)
+                except ValueError:
+                    pass
 
     async def send_message(self, room: str, message_list: list[str]) -> None:
         message = room + "|" + "|".join(message_list)
         await self.websocket.send(message)
         self.last_message = message
 
+    async def send_batch(self, rooms_and_messages: list[tuple[str, list[str]]]) -> None:
+        # Showdown reads "ROOM|line\nline..." as several commands for one room,
+        # so consecutive commands for the same room share a single frame.
+        frames: list[tuple[str, list[str]]] = []
+        for room, message_list in rooms_and_messages:
+            line = "|".join(message_list)
+            if frames and frames[-1][0] == room:
+                frames[-1][1].append(line)
+            else:
+                frames.append((room, [line]))
+
+        for room, lines in frames:
+            message = room + "|" + "\n".join(lines)
+            await self.websocket.send(message)
+            self.last_message = message
+
     async def close(self) -> None:
         await self.websocket.close()
+        await self.http_client.aclose()
 
     async def get_id_and_challstr(self) -> tuple[str, str]:
         while True:
             message = await self.receive_message()
             for room, line in iter_messages(message):
                 if line.startswith("|challstr|"):
-                    _, _, client_id, challstr = line.split("|", 3)
+                    client_id, _, challstr = line[len("|challstr|") :].partition("|")
                     return client_id, challstr
 
     async def login(self) -> str:
@@ -82,23 +169,22 @@ class PSWebsocketClient:
         guest_login = self.password is None
 
         if guest_login:
-            response = requests.post(
-                self.login_uri,
-                data={
-                    "act": "getassertion",
-                    "userid": self.username,
-                    "challstr": "|".join([client_id, challstr]),
-                },
-            )
+            data = {
+                "act": "getassertion",
+                "userid": self.username,
+                "challstr": "|".join([client_id, challstr]),
+            }
         else:
-            response = requests.post(
-                self.login_uri,
-                data={
-                    "name": self.username,
-                    "pass": self.password,
-                    "challstr": "|".join([client_id, challstr]),
-                },
-            )
+            data = {
+                "name": self.username,
+                "pass": self.password,
+                "challstr": "|".join([client_id, challstr]),
+            }
+
+        try:
+            response = await self.http_client.post(self.login_uri, data=data)
+        except httpx.HTTPError as exc:
+            raise LoginError("Could not reach login server: {}".format(exc)) from exc
 
         if response.status_code != 200:
             raise LoginError("Could not get assertion")
@@ -106,47 +192,136 @@ class PSWebsocketClient:
         if guest_login:
             assertion = response.text
         else:
-            response_json = json.loads(response.text[1:])
+            response_json = orjson.loads(response.text[1:])
             if "actionsuccess" not in response_json:
                 raise LoginError("Could not log-in: {}".format(response_json))
             assertion = response_json.get("assertion")
 
         message = ["/trn " + self.username + ",0," + assertion]
         await self.send_message("", message)
-        await asyncio.sleep(1)
+        await self.wait_for_login()
         return self.username if guest_login else response_json["curuser"]["userid"]
 
+    async def wait_for_login(self, timeout_s: float = 1.0) -> bool:
+        # Showdown confirms /trn with "|updateuser|<rank><name>|1|...". Waiting
+        # at most timeout_s keeps this no slower than the old fixed sleep.
+        loop = asyncio.get_running_loop()
+        user_id = to_id(self.username)
+        try:
+            async with asyncio.timeout_at(loop.time() + timeout_s):
+                while True:
+                    message = await self.receive_message()
+                    for room, line in iter_messages(message):
+                        if not line.startswith("|updateuser|"):
+                            continue
+                        name, _, rest = line[len("|updateuser|") :].partition("|")
+                        named = rest.partition("|")[0]
+                        if named == "1" and to_id(name) == user_id:
+                            return True
+        except asyncio.TimeoutError:
+            pass
+        return False
+
     async def join_room(self, room_name: str) -> None:
-        await self.send_message("", ["/join {}".format(room_name)])
+        # Rejoining would make Showdown send "|request|null" on the leave and
+        # show the opponent a leave/rejoin, so a room is only joined once.
+        if room_name not in self.rooms:
+            await self.send_message("", ["/join {}".format(room_name)])
+            self.rooms.add(room_name)
+
+    async def discard_pending(self) -> None:
+        # Drop frames left over from earlier commands (late requests, replays)
+        # once nothing has arrived for DRAIN_IDLE_S, for at most DRAIN_MAX_S.
+        loop = asyncio.get_running_loop()
+        cap = loop.time() + DRAIN_MAX_S
+        try:
+            async with asyncio.timeout_at(min(cap, loop.time() + DRAIN_IDLE_S)) as idle:
+                while True:
+                    await self.receive_message()
+                    idle.reschedule(min(cap, loop.time() + DRAIN_IDLE_S))
+        except asyncio.TimeoutError:
+            pass
+
+
+def to_id(name: str) -> str:
+    return "".join(ch for ch in name.lower() if ch.isascii() and ch.isalnum())
 
 
 def iter_messages(raw: str):
+    # Split on "\n" only: str.splitlines() also breaks on characters such as
+    # U+2028 that can legitimately appear inside chat text or request JSON.
     room = ""
     for line in raw.split("\n"):
         if not line:
             continue
-        if line.startswith(">"):
+        if line[0] == ">":
             room = line[1:]
             continue
         yield room, line
 
 
+def parse_tag(line: str) -> tuple[str, str]:
+    # "|tag|payload" -> ("tag", "payload"); bare tags such as "|tie" get an
+    # empty payload. Lines that are not protocol messages give ("", "").
+    parts = line.split("|", 2)
+    if len(parts) < 2 or parts[0]:
+        return "", ""
+    return parts[1], parts[2] if len(parts) == 3 else ""
+
+
+def require_msgpack():
+    if msgpack is None:
+        raise ValueError("msgpack is required for .msgpack state files")
+    return msgpack
+
+
 def load_state(path: Path) -> dict[str, Any]:
     if not path.exists():
         return {}
+    if path.suffix == ".msgpack":
+        unpackb = require_msgpack().unpackb
+        try:
+            return unpackb(path.read_bytes(), raw=False)
+        except ValueError:
+            return {}
     try:
-        return json.loads(path.read_text())
-    except json.JSONDecodeError:
+        return orjson.loads(path.read_bytes())
+    except orjson.JSONDecodeError:
         return {}
 
 
 def save_state(path: Path, state: dict[str, Any]) -> None:
+    if path.suffix == ".msgpack":
+        data = require_msgpack().packb(state, use_bin_type=True)
+    else:
+        data = orjson.dumps(state, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
     path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(json.dumps(state, indent=2, sort_keys=True))
+    # Write to a uniquely named sibling temp file and rename it into place, so a
+    # crash never leaves a torn file and concurrent writers never share a temp.
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_name, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_name)
+        raise
+
+
+async def load_state_async(path: Path) -> dict[str, Any]:
+    return await asyncio.to_thread(load_state, path)
+
+
+async def save_state_async(path: Path, state: dict[str, Any]) -> None:
+    await asyncio.to_thread(save_state, path, state)
 
 
 def resolve_config(args: argparse.Namespace) -> tuple[str, str | None, str, Path]:
     state_path = Path(args.state_path).expanduser()
+    if state_path.suffix == ".msgpack":
+        # Fail before connecting rather than after a choice has been sent.
+        require_msgpack()
     state = load_state(state_path)
 
     username = args.ps_username or state.get("ps_username")
@@ -162,24 +337,24 @@ def resolve_config(args: argparse.Namespace) -> tuple[str, str | None, str, Path
 
 
 async def wait_for_battle_init(client: PSWebsocketClient, timeout_s: int) -> BattleInit:
-    deadline = time.time() + timeout_s
+    loop = asyncio.get_running_loop()
     battle_id = None
     title = None
-    while time.time() < deadline:
-        remaining = max(0.1, deadline - time.time())
-        try:
-            message = await asyncio.wait_for(client.receive_message(), timeout=remaining)
-        except asyncio.TimeoutError:
-            break
-        for room, line in iter_messages(message):
-            if line == "|init|battle":
-                battle_id = room
-            elif battle_id and room == battle_id and line.startswith("|title|"):
-                title = line.split("|", 2)[2]
-                return BattleInit(battle_id=battle_id, title=title)
-
-        if battle_id:
-            return BattleInit(battle_id=battle_id, title=title)
+    try:
+        async with asyncio.timeout_at(loop.time() + timeout_s):
+            while True:
+                message = await client.receive_message()
+                for room, line in iter_messages(message):
+                    if line == "|init|battle":
+                        battle_id = room
+                    elif battle_id and room == battle_id and line.startswith("|title|"):
+                        title = line[len("|title|") :]
+                        return BattleInit(battle_id=battle_id, title=title)
+
+                if battle_id:
+                    return BattleInit(battle_id=battle_id, title=title)
+    except asyncio.TimeoutError:
+        pass
 
     raise RequestTimeout("Timed out waiting for battle to start")
 
@@ -189,94 +364,149 @@ async def wait_for_request(
     battle_id: str,
     timeout_s: int,
 ) -> tuple[dict[str, Any] | None, int | None, str | None]:
-    deadline = time.time() + timeout_s
+    loop = asyncio.get_running_loop()
     last_request = None
     last_turn = None
     last_error = None
+    room_marker = ">" + battle_id
 
-    while time.time() < deadline:
-        remaining = max(0.1, deadline - time.time())
-        try:
-            message = await asyncio.wait_for(client.receive_message(), timeout=remaining)
-        except asyncio.TimeoutError:
-            break
-
-        for room, line in iter_messages(message):
-            if room != battle_id:
-                continue
-            if line.startswith("|error|"):
-                last_error = line.split("|", 2)[2]
-            if line.startswith("|turn|"):
-                try:
-                    last_turn = int(line.split("|", 2)[2])
-                except ValueError:
-                    pass
-            if line.startswith("|request|"):
-                payload = line.split("|", 2)[2]
-                if payload:
-                    last_request = json.loads(payload)
-                else:
-                    last_request = {}
-                return last_request, last_turn, last_error
+    try:
+        async with asyncio.timeout_at(loop.time() + timeout_s):
+            while True:
+                message = await client.receive_message()
+                # Skip frames for other rooms, or with nothing we track, without
+                # splitting them into lines.
+                if room_marker not in message or (
+                    "|request|" not in message
+                    and "|turn|" not in message
+                    and "|error|" not in message
+                ):
+                    continue
+                for room, line in iter_messages(message):
+                    if room != battle_id:
+                        continue
+                    tag, payload = parse_tag(line)
+                    if tag == "error":
+                        last_error = payload
+                    elif tag == "turn":
+                        try:
+                            last_turn = int(payload)
+                        except ValueError:
+                            pass
+                    elif tag == "request":
+                        if payload:
+                            last_request = orjson.loads(payload)
+                        else:
+                            last_request = {}
+                        return last_request, last_turn, last_error
+    except asyncio.TimeoutError:
+        pass
 
     return last_request, last_turn, last_error
 
 
+# Event handlers return True when wait_for_request_with_events should stop.
+def _on_win(update: BattleUpdate, line: str, payload: str) -> bool:
+    update.winner = payload
+    update.finished = True
+    update.events.append(line)
+    return True
+
+
+def _on_tie(update: BattleUpdate, line: str, payload: str) -> bool:
+    update.tie = True
+    update.finished = True
+    update.events.append(line)
+    return True
+
+
+def _on_error(update: BattleUpdate, line: str, payload: str) -> bool:
+    update.last_error = payload
+    update.events.append(line)
+    return False
+
+
+def _on_turn(update: BattleUpdate, line: str, payload: str) -> bool:
+    try:
+        update.last_turn = int(payload)
+    except ValueError:
+        pass
+    update.events.append(line)
+    return False
+
+
+def _on_request(update: BattleUpdate, line: str, payload: str) -> bool:
+    update.last_request = orjson.loads(payload) if payload else {}
+    return True
+
+
+EVENT_HANDLERS = {
+    "win": _on_win,
+    "tie": _on_tie,
+    "error": _on_error,
+    "turn": _on_turn,
+    "request": _on_request,
+}
+
+
+def apply_battle_message(update: BattleUpdate, battle_id: str, message: str) -> bool:
+    # Every battle-room line is kept as an event, so only frames for other rooms
+    # can be skipped wholesale.
+    if ">" + battle_id not in message:
+        return False
+    done = False
+    for room, line in iter_messages(message):
+        if room != battle_id:
+            continue
+        tag, payload = parse_tag(line)
+        handler = EVENT_HANDLERS.get(tag)
+        if handler is None:
+            update.events.append(line)
+        elif handler(update, line, payload):
+            if update.finished:
+                return True
+            # Keep reading: the turn's battle log follows its |request|.
+            done = True
+    return done
+
+
 async def wait_for_request_with_events(
     client: PSWebsocketClient,
     battle_id: str,
     timeout_s: int,
 ) -> tuple[dict[str, Any] | None, int | None, str | None, list[str], bool, str | None, bool]:
-    deadline = time.time() + timeout_s
-    last_request = None
-    last_turn = None
-    last_error = None
-    events: list[str] = []
-    finished = False
-    winner = None
-    tie = False
-
-    while time.time() < deadline:
-        remaining = max(0.1, deadline - time.time())
-        try:
-            message = await asyncio.wait_for(client.receive_message(), timeout=remaining)
-        except asyncio.TimeoutError:
-            break
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_s
+    update = BattleUpdate()
+    room_marker = ">" + battle_id
 
-        for room, line in iter_messages(message):
-            if room != battle_id:
-                continue
-            if line.startswith("|win|"):
-                winner = line.split("|", 2)[2]
-                finished = True
-                events.append(line)
-                return last_request, last_turn, last_error, events, finished, winner, tie
-            if line.startswith("|tie|"):
-                tie = True
-                finished = True
-                events.append(line)
-                return last_request, last_turn, last_error, events, finished, winner, tie
-            if line.startswith("|error|"):
-                last_error = line.split("|", 2)[2]
-                events.append(line)
-                continue
-            if line.startswith("|turn|"):
-                try:
-                    last_turn = int(line.split("|", 2)[2])
-                except ValueError:
-                    pass
-                events.append(line)
-                continue
-            if line.startswith("|request|"):
-                payload = line.split("|", 2)[2]
-                if payload:
-                    last_request = json.loads(payload)
-                else:
-                    last_request = {}
-                return last_request, last_turn, last_error, events, finished, winner, tie
-            events.append(line)
+    try:
+        async with asyncio.timeout_at(deadline):
+            while True:
+                message = await client.receive_message()
+                if apply_battle_message(update, battle_id, message):
+                    break
+    except asyncio.TimeoutError:
+        return update.as_tuple()
+
+    # Showdown sends a turn's |request| before the lines describing that turn,
+    # so keep reading while battle frames are still arriving. Only battle frames
+    # extend the idle window, and the whole drain is capped by DRAIN_MAX_S and
+    # the caller's deadline.
+    drain_deadline = min(deadline, loop.time() + DRAIN_MAX_S)
+    try:
+        idle_deadline = min(drain_deadline, loop.time() + DRAIN_IDLE_S)
+        async with asyncio.timeout_at(idle_deadline) as drain:
+            while not update.finished:
+                message = await client.receive_message()
+                if room_marker not in message:
+                    continue
+                apply_battle_message(update, battle_id, message)
+                drain.reschedule(min(drain_deadline, loop.time() + DRAIN_IDLE_S))
+    except asyncio.TimeoutError:
+        pass
 
-    return last_request, last_turn, last_error, events, finished, winner, tie
+    return update.as_tuple()
 
 
 def build_options(request_json: dict[str, Any] | None) -> dict[str, Any]:
@@ -308,235 +538,335 @@ def build_options(request_json: dict[str, Any] | None) -> dict[str, Any]:
         options["force_switch"] = True
 
     if active and active.get("moves"):
-        for idx, move in enumerate(active["moves"], start=1):
-            if move.get("disabled"):
-                continue
-            options["moves"].append(
-                {
-                    "slot": idx,
-                    "id": move.get("id"),
-                    "name": move.get("move"),
-                    "pp": move.get("pp"),
-                    "maxpp": move.get("maxpp"),
-                    "target": move.get("target"),
-                }
-            )
+        options["moves"] = [
+            {
+                "slot": idx,
+                "id": move.get("id"),
+                "name": move.get("move"),
+                "pp": move.get("pp"),
+                "maxpp": move.get("maxpp"),
+                "target": move.get("target"),
+            }
+            for idx, move in enumerate(active["moves"], start=1)
+            if not move.get("disabled")
+        ]
 
     side = request_json.get("side")
     if side and side.get("pokemon"):
-        for idx, pkmn in enumerate(side["pokemon"], start=1):
-            if pkmn.get("active"):
-                continue
-            condition = pkmn.get("condition", "")
-            if "fnt" in condition:
-                continue
-            options["switches"].append(
-                {
-                    "slot": idx,
-                    "ident": pkmn.get("ident"),
-                    "details": pkmn.get("details"),
-                    "condition": condition,
-                }
-            )
+        options["switches"] = [
+            {
+                "slot": idx,
+                "ident": pkmn.get("ident"),
+                "details": pkmn.get("details"),
+                "condition": condition,
+            }
+            for idx, pkmn in enumerate(side["pokemon"], start=1)
+            if not pkmn.get("active")
+            and "fnt" not in (condition := pkmn.get("condition", ""))
+        ]
 
     return options
 
 
-async def start_battle(args: argparse.Namespace) -> None:
-    username, password, websocket_uri, state_path = resolve_config(args)
-    client = await PSWebsocketClient.create(username, password, websocket_uri)
-    try:
-        await client.login()
-        if args.team is not None:
-            await client.send_message("", ["/utm {}".format(args.team)])
-        else:
-            await client.send_message("", ["/utm None"])
-        await client.send_message("", ["/search {}".format(args.pokemon_format)])
-        init = await wait_for_battle_init(client, args.timeout_s)
-        await client.send_message(init.battle_id, ["/timer on"])
-
-        request_json, turn, error = await wait_for_request(
-            client, init.battle_id, args.request_timeout_s
-        )
-        options = build_options(request_json)
-        rqid = request_json.get("rqid") if request_json else None
-
-        state = load_state(state_path)
-        state.update(
-            {
-                "websocket_uri": websocket_uri,
-                "ps_username": username,
-                "ps_password": password,
-                "battle_id": init.battle_id,
-                "rqid": rqid,
-                "turn": turn,
-                "request": request_json,
-                "updated_at": time.time(),
-            }
-        )
-        save_state(state_path, state)
-
-        output = {
-            "battle_id": init.battle_id,
-            "title": init.title,
-            "turn": turn,
-            "rqid": rqid,
-            "error": error,
-            "request": request_json,
-            "options": options,
-            "state_path": str(state_path),
-        }
-        print(json.dumps(output))
-    finally:
-        await client.close()
+async def current_request(
+    client: PSWebsocketClient,
+    battle_id: str,
+    timeout_s: int,
+) -> tuple[dict[str, Any] | None, int | None, str | None]:
+    # Showdown sends the current request only on a fresh join. For a room this
+    # connection is already in, use the latest one it has received instead.
+    if battle_id in client.rooms and battle_id in client.latest_requests:
+        payload = client.latest_requests[battle_id]
+        request_json = orjson.loads(payload) if payload else {}
+        return request_json, client.latest_turns.get(battle_id), None
+    await client.join_room(battle_id)
+    return await wait_for_request(client, battle_id, timeout_s)
 
 
-async def poll_battle(args: argparse.Namespace) -> None:
-    username, password, websocket_uri, state_path = resolve_config(args)
+def resolve_battle_id(args: argparse.Namespace, state_path: Path) -> str:
     battle_id = args.battle_id
     if not battle_id:
         battle_id = load_state(state_path).get("battle_id")
     if not battle_id:
         raise ValueError("battle_id is required (or provide in state)")
+    return battle_id
+
 
+async def connect_client(
+    username: str, password: str | None, websocket_uri: str
+) -> PSWebsocketClient:
     client = await PSWebsocketClient.create(username, password, websocket_uri)
     try:
         await client.login()
-        await client.join_room(battle_id)
-        request_json, turn, error = await wait_for_request(
-            client, battle_id, args.timeout_s
-        )
-        options = build_options(request_json)
-        rqid = request_json.get("rqid") if request_json else None
+    except BaseException:
+        await client.close()
+        raise
+    return client
 
-        state = load_state(state_path)
-        state.update(
-            {
-                "websocket_uri": websocket_uri,
-                "ps_username": username,
-                "ps_password": password,
-                "battle_id": battle_id,
-                "rqid": rqid,
-                "turn": turn,
-                "request": request_json,
-                "updated_at": time.time(),
-            }
-        )
-        save_state(state_path, state)
 
-        output = {
-            "battle_id": battle_id,
+@asynccontextmanager
+async def logged_in_client(username: str, password: str | None, websocket_uri: str):
+    client = await connect_client(username, password, websocket_uri)
+    try:
+        yield client
+    finally:
+        await client.close()
+
+
+async def run_start(
+    client: PSWebsocketClient, args: argparse.Namespace, state_path: Path
+) -> dict[str, Any]:
+    team = args.team if args.team is not None else "None"
+    await client.send_batch(
+        [
+            ("", ["/utm {}".format(team)]),
+            ("", ["/search {}".format(args.pokemon_format)]),
+        ]
+    )
+    init = await wait_for_battle_init(client, args.timeout_s)
+    client.rooms.add(init.battle_id)
+    await client.send_message(init.battle_id, ["/timer on"])
+
+    request_json, turn, error = await wait_for_request(
+        client, init.battle_id, args.request_timeout_s
+    )
+    options = build_options(request_json)
+    rqid = request_json.get("rqid") if request_json else None
+
+    state = await load_state_async(state_path)
+    state.update(
+        {
+            "websocket_uri": client.address,
+            "ps_username": client.username,
+            "ps_password": client.password,
+            "battle_id": init.battle_id,
+            "rqid": rqid,
             "turn": turn,
-            "error": error,
+            "request": request_json,
+            "updated_at": time.time(),
+        }
+    )
+    await save_state_async(state_path, state)
+
+    return {
+        "battle_id": init.battle_id,
+        "title": init.title,
+        "turn": turn,
+        "rqid": rqid,
+        "error": error,
+        "request": request_json,
+        "options": options,
+        "state_path": str(state_path),
+    }
+
+
+async def run_poll(
+    client: PSWebsocketClient, args: argparse.Namespace, state_path: Path
+) -> dict[str, Any]:
+    battle_id = resolve_battle_id(args, state_path)
+    request_json, turn, error = await current_request(
+        client, battle_id, args.timeout_s
+    )
+    options = build_options(request_json)
+    rqid = request_json.get("rqid") if request_json else None
+
+    state = await load_state_async(state_path)
+    state.update(
+        {
+            "websocket_uri": client.address,
+            "ps_username": client.username,
+            "ps_password": client.password,
+            "battle_id": battle_id,
             "rqid": rqid,
+            "turn": turn,
             "request": request_json,
-            "options": options,
-            "state_path": str(state_path),
+            "updated_at": time.time(),
         }
-        print(json.dumps(output))
-    finally:
-        await client.close()
+    )
+    await save_state_async(state_path, state)
+
+    return {
+        "battle_id": battle_id,
+        "turn": turn,
+        "error": error,
+        "rqid": rqid,
+        "request": request_json,
+        "options": options,
+        "state_path": str(state_path),
+    }
+
+
+async def run_choose(
+    client: PSWebsocketClient, args: argparse.Namespace, state_path: Path
+) -> dict[str, Any]:
+    battle_id = resolve_battle_id(args, state_path)
+    choice = args.choice.strip()
+    if not choice:
+        raise ValueError("choice must be non-empty")
+    if choice.startswith("/choose "):
+        payload = choice
+    else:
+        payload = "/choose " + choice
+
+    rqid = args.rqid
+    request_json = None
+    turn = None
+    error = None
+    if not args.no_refresh:
+        request_json, turn, error = await current_request(
+            client, battle_id, args.timeout_s
+        )
+        if request_json:
+            rqid = request_json.get("rqid")
+    else:
+        await client.join_room(battle_id)
+        if rqid is None:
+            rqid = (await load_state_async(state_path)).get("rqid")
+
+    if rqid is None:
+        raise ValueError("rqid is required (or use refresh polling)")
+
+    await client.send_message(battle_id, [payload, str(rqid)])
+
+    # wait for the next request (next turn/state) after submitting the choice
+    next_request, next_turn, next_error, events, finished, winner, tie = await wait_for_request_with_events(
+        client, battle_id, args.post_timeout_s
+    )
+    next_options = build_options(next_request)
+    next_rqid = next_request.get("rqid") if next_request else None
+
+    # Compare against None explicitly: turn 0 and an empty request are real values.
+    state = await load_state_async(state_path)
+    state["websocket_uri"] = client.address
+    state["ps_username"] = client.username
+    state["ps_password"] = client.password
+    state["battle_id"] = battle_id
+    state["rqid"] = rqid if next_rqid is None else next_rqid
+    state["turn"] = turn if next_turn is None else next_turn
+    state["request"] = request_json if next_request is None else next_request
+    state["finished"] = finished
+    state["winner"] = winner
+    state["tie"] = tie
+    state["updated_at"] = time.time()
+    await save_state_async(state_path, state)
+
+    return {
+        "battle_id": battle_id,
+        "sent": payload,
+        "rqid": rqid,
+        "error": next_error or error,
+        "turn": next_turn,
+        "request": next_request,
+        "options": next_options,
+        "events": events,
+        "finished": finished,
+        "winner": winner,
+        "tie": tie,
+        "state_path": str(state_path),
+    }
+
+
+async def start_battle(args: argparse.Namespace) -> None:
+    username, password, websocket_uri, state_path = resolve_config(args)
+    async with logged_in_client(username, password, websocket_uri) as client:
+        print(orjson.dumps(await run_start(client, args, state_path)).decode())
+
+
+async def poll_battle(args: argparse.Namespace) -> None:
+    username, password, websocket_uri, state_path = resolve_config(args)
+    args.battle_id = resolve_battle_id(args, state_path)
+    async with logged_in_client(username, password, websocket_uri) as client:
+        print(orjson.dumps(await run_poll(client, args, state_path)).decode())
 
 
 async def choose_action(args: argparse.Namespace) -> None:
     username, password, websocket_uri, state_path = resolve_config(args)
-    battle_id = args.battle_id
-    if not battle_id:
-        battle_id = load_state(state_path).get("battle_id")
-    if not battle_id:
-        raise ValueError("battle_id is required (or provide in state)")
+    args.battle_id = resolve_battle_id(args, state_path)
+    async with logged_in_client(username, password, websocket_uri) as client:
+        print(orjson.dumps(await run_choose(client, args, state_path)).decode())
 
-    client = await PSWebsocketClient.create(username, password, websocket_uri)
-    try:
-        await client.login()
-        await client.join_room(battle_id)
-        choice = args.choice.strip()
-        if not choice:
-            raise ValueError("choice must be non-empty")
-        if choice.startswith("/choose "):
-            payload = choice
-        else:
-            payload = "/choose " + choice
-
-        rqid = args.rqid
-        request_json = None
-        turn = None
-        error = None
-        if not args.no_refresh:
-            request_json, turn, error = await wait_for_request(
-                client, battle_id, args.timeout_s
-            )
-            if request_json:
-                rqid = request_json.get("rqid")
-        elif rqid is None:
-            rqid = load_state(state_path).get("rqid")
 
-        if rqid is None:
-            raise ValueError("rqid is required (or use refresh polling)")
+class CommandParser(argparse.ArgumentParser):
+    """Argument parser for `serve` commands that raises instead of exiting.
 
-        await client.send_message(battle_id, [payload, str(rqid)])
+    Help is disabled so `--help` cannot print usage to stdout and exit.
+    """
 
-        # wait for the next request (next turn/state) after submitting the choice
-        next_request, next_turn, next_error, events, finished, winner, tie = await wait_for_request_with_events(
-            client, battle_id, args.post_timeout_s
-        )
-        next_options = build_options(next_request)
-        next_rqid = next_request.get("rqid") if next_request else None
+    def __init__(self, *args, **kwargs):
+        kwargs["add_help"] = False
+        super().__init__(*args, **kwargs)
 
-        state = load_state(state_path)
-        state.update(
-            {
-                "websocket_uri": websocket_uri,
-                "ps_username": username,
-                "ps_password": password,
-                "battle_id": battle_id,
-                "rqid": next_rqid or rqid,
-                "turn": next_turn or turn,
-                "request": next_request or request_json,
-                "finished": finished,
-                "winner": winner,
-                "tie": tie,
-                "updated_at": time.time(),
-            }
+    def error(self, message: str):
+        raise ValueError(message)
+
+
+def command_argv(command: dict[str, Any]) -> list[str]:
+    argv = [str(command.get("command", ""))]
+    for key, value in command.items():
+        if key == "command" or value is None or value is False:
+            continue
+        flag = "--" + key.replace("_", "-")
+        if value is True:
+            argv.append(flag)
+        else:
+            argv.extend([flag, str(value)])
+    return argv
+
+
+async def stdin_lines():
+    # connect_read_pipe only accepts pipes and sockets (uvloop aborts on other
+    # file types), so redirected files and terminals are read on a thread.
+    mode = os.fstat(sys.stdin.fileno()).st_mode
+    if stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
         )
-        save_state(state_path, state)
+        while line := await reader.readline():
+            yield line
+    else:
+        while line := await asyncio.to_thread(sys.stdin.buffer.readline):
+            yield line
 
-        output = {
-            "battle_id": battle_id,
-            "sent": payload,
-            "rqid": rqid,
-            "error": next_error or error,
-            "turn": next_turn,
-            "request": next_request,
-            "options": next_options,
-            "events": events,
-            "finished": finished,
-            "winner": winner,
-            "tie": tie,
-            "state_path": str(state_path),
-        }
-        print(json.dumps(output))
-    finally:
-        await client.close()
 
+async def serve(args: argparse.Namespace) -> None:
+    username, password, websocket_uri, state_path = resolve_config(args)
+    command_parser = CommandParser(prog="serve")
+    add_battle_commands(command_parser.add_subparsers(dest="command", required=True))
 
-def build_parser() -> argparse.ArgumentParser:
-    parser = argparse.ArgumentParser(description="Pokemon Showdown stateless client")
-    parser.add_argument(
-        "--websocket-uri",
-        required=False,
-        help="e.g. wss://sim3.psim.us/showdown/websocket",
-    )
-    parser.add_argument("--ps-username", required=False)
-    parser.add_argument("--ps-password", default=None)
-    parser.add_argument(
-        "--state-path",
-        default="ps_client_state.json",
-        help="Path to persist battle_id/rqid/credentials",
-    )
+    client = await connect_client(username, password, websocket_uri)
+    try:
+        async for line in stdin_lines():
+            if not line.strip():
+                continue
+            try:
+                command = orjson.loads(line)
+                if not isinstance(command, dict):
+                    raise ValueError("command must be a JSON object")
+                command_args = command_parser.parse_args(command_argv(command))
+                if client is None:
+                    client = await connect_client(username, password, websocket_uri)
+                else:
+                    await client.discard_pending()
+                output = await command_args.run(client, command_args, state_path)
+            except (LoginError, RequestTimeout, ValueError) as exc:
+                output = {"error": str(exc)}
+            except Exception as exc:
+                # Connection-level failures (closed websocket, network errors):
+                # report them and reconnect on the next command.
+                output = {"error": "{}: {}".format(type(exc).__name__, exc)}
+                if client is not None:
+                    with suppress(Exception):
+                        await client.close()
+                    client = None
+            print(orjson.dumps(output).decode(), flush=True)
+    finally:
+        if client is not None:
+            await client.close()
 
-    subparsers = parser.add_subparsers(dest="command", required=True)
 
+def add_battle_commands(subparsers) -> None:
     start = subparsers.add_parser("start", help="Start a ladder battle")
     start.add_argument("--pokemon-format", required=True)
     start.add_argument("--team", default=None, help="Packed team or 'None'")
@@ -547,12 +877,12 @@ def build_parser() -> argparse.ArgumentParser:
         default=30,
         help="How long to wait for the first request after battle start",
     )
-    start.set_defaults(func=start_battle)
+    start.set_defaults(func=start_battle, run=run_start)
 
     poll = subparsers.add_parser("poll", help="Poll current battle request")
     poll.add_argument("--battle-id", required=False)
     poll.add_argument("--timeout-s", type=int, default=30)
-    poll.set_defaults(func=poll_battle)
+    poll.set_defaults(func=poll_battle, run=run_poll)
 
     choose = subparsers.add_parser("choose", help="Submit a battle choice")
     choose.add_argument("--battle-id", required=False)
@@ -579,7 +909,32 @@ def build_parser() -> argparse.ArgumentParser:
         default=30,
         help="How long to wait for the next request after submitting a choice.",
     )
-    choose.set_defaults(func=choose_action)
+    choose.set_defaults(func=choose_action, run=run_choose)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Pokemon Showdown stateless client")
+    parser.add_argument(
+        "--websocket-uri",
+        required=False,
+        help="e.g. wss://sim3.psim.us/showdown/websocket",
+    )
+    parser.add_argument("--ps-username", required=False)
+    parser.add_argument("--ps-password", default=None)
+    parser.add_argument(
+        "--state-path",
+        default="ps_client_state.json",
+        help="Path to persist battle_id/rqid/credentials (a .msgpack suffix stores msgpack)",
+    )
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_battle_commands(subparsers)
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Keep one logged-in connection and run JSON commands read from stdin",
+    )
+    serve_parser.set_defaults(func=serve)
 
     return parser
 
@@ -589,9 +944,17 @@ def main() -> None:
     args = parser.parse_args()
 
     try:
-        asyncio.run(args.func(args))
+        import uvloop
+    except ImportError:
+        loop_factory = None
+    else:
+        loop_factory = uvloop.new_event_loop
+
+    try:
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(args.func(args))
     except (LoginError, RequestTimeout, ValueError) as exc:
-        print(json.dumps({"error": str(exc)}))
+        print(orjson.dumps({"error": str(exc)}).decode())
         sys.exit(1)
 
 